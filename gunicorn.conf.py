@@ -0,0 +1,50 @@
+import gc
+import os
+
+__doc__ = '''
+Production configuration for running Strokes under gunicorn:
+
+    gunicorn -c gunicorn.conf.py strokes:app
+
+The application is imported once in the master process, so graphics.txt and
+dictionary.txt are only parsed once. Right before forking, everything that's
+been allocated so far is moved to the permanent GC generation, so that the
+garbage collector in workers doesn't touch (and thus copy) the pages holding
+STROKES_DB and PINYIN_DB.
+
+Tunables (environment variables):
+
+    STROKES_BIND     - address to listen on, default 0.0.0.0:5000
+    STROKES_WORKERS  - number of worker processes, default 2
+    STROKES_THREADS  - threads per worker, default 4. PDF generation mostly
+                       waits for html2pdf, so threads are cheaper than workers
+    STROKES_TIMEOUT  - seconds before a silent worker is restarted, default
+                       300 because large PDFs take a while
+
+SIGHUP makes the master gracefully re-fork its workers. They get the same
+code and configuration, because preload_app means strokes.py is not
+re-imported and the environment of the running master can't change. After
+changing STROKES_* or the code, restart the server, or send SIGUSR2 and then
+SIGTERM to the old master to switch over without dropping connections.
+'''
+
+bind = os.environ.get('STROKES_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('STROKES_WORKERS', '2'))
+threads = int(os.environ.get('STROKES_THREADS', '4'))
+timeout = int(os.environ.get('STROKES_TIMEOUT', '300'))
+graceful_timeout = timeout
+
+preload_app = True
+# Docker's /tmp is often on overlayfs, where heartbeat writes can block.
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+accesslog = '-'
+
+
+def when_ready(server):
+    # imported here because the app has already been loaded by now
+    import strokes
+    strokes.warm_caches()
+    gc.collect()
+    gc.freeze()
+    server.log.info('Froze %d objects before forking workers',
+                    gc.get_freeze_count())
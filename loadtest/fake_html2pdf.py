@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import argparse
+import http.server
+import io
+import logging
+import random
+import threading
+import time
+import unittest
+import urllib.parse
+
+import requests
+
+from PyPDF2 import PdfFileMerger
+
+__doc__ = '''
+A stand-in for the d33tah/html2pdf container, so that Strokes can be load
+tested on a laptop without headless Chrome.
+
+It speaks the same protocol as the real thing - POST /html2pdf with an
+urlencoded "url" field - and answers every request with a valid single-page
+PDF after a configurable delay. Some requests can be made to fail on purpose
+to see how Strokes copes with a flaky renderer.
+
+Example:
+
+    python3 fake_html2pdf.py --port 4000 --latency 0.5 --jitter 0.2 \\
+        --error-rate 0.01
+
+and then run Strokes with HTML2PDF_URL=http://localhost:4000.
+'''
+
+
+def minimal_pdf(padding=0):
+    """Builds a valid one-page PDF. The page's content stream is made of
+    `padding` spaces, which lets us make pages as heavy as real ones so that
+    merging them costs about the same."""
+    content = b' ' * padding
+    objs = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 /MediaBox [0 0 595 842] >>',
+        b'<< /Type /Page /Parent 2 0 R /Contents 4 0 R >>',
+        b'<< /Length %d >>\nstream\n%s\nendstream' % (len(content), content),
+    ]
+    out = b'%PDF-1.1\n'
+    offsets = []
+    for n, obj in enumerate(objs, 1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n%s\nendobj\n' % (n, obj)
+    xref_offset = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objs) + 1)
+    for offset in offsets:
+        out += b'%010d 00000 n \n' % offset
+    out += b'trailer\n<< /Root 1 0 R /Size %d >>\n' % (len(objs) + 1)
+    out += b'startxref\n%d\n%%%%EOF\n' % xref_offset
+    return out
+
+
+class FakeHtml2PdfHandler(http.server.BaseHTTPRequestHandler):
+    """Configured through class attributes by make_server()."""
+
+    latency = 2.0
+    jitter = 0.5
+    error_rate = 0.0
+    pdf = minimal_pdf()
+    slots = None
+
+    def log_message(self, fmt, *args):
+        logging.debug(fmt, *args)
+
+    def send_body(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def render_delay(self):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        return max(0.0, delay)
+
+    def do_POST(self):
+        if self.path != '/html2pdf':
+            return self.send_body(404, 'text/plain', b'Not found')
+        length = int(self.headers.get('Content-Length', 0))
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode('ascii'))
+        if 'url' not in form:
+            return self.send_body(400, 'text/plain', b'No url given')
+
+        # the real renderer only has so many Chrome tabs
+        if self.slots is not None:
+            self.slots.acquire()
+        try:
+            time.sleep(self.render_delay())
+        finally:
+            if self.slots is not None:
+                self.slots.release()
+
+        if random.random() < self.error_rate:
+            return self.send_body(500, 'text/plain', b'Simulated failure')
+        self.send_body(200, 'application/pdf', self.pdf)
+
+
+def make_server(host, port, latency, jitter, error_rate, page_bytes=0,
+                concurrency=0):
+    attrs = {
+        'latency': latency,
+        'jitter': jitter,
+        'error_rate': error_rate,
+        'pdf': minimal_pdf(page_bytes),
+        'slots': threading.Semaphore(concurrency) if concurrency else None,
+    }
+    handler = type('Handler', (FakeHtml2PdfHandler,), attrs)
+    return http.server.ThreadingHTTPServer((host, port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Fake html2pdf server for load testing Strokes.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=2.0,
+                        help='mean seconds spent per page (default: 2.0)')
+    parser.add_argument('--jitter', type=float, default=0.5,
+                        help='latency varies uniformly by +/- this much')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of pages answered with HTTP 500')
+    parser.add_argument('--page-bytes', type=int, default=0,
+                        help='pad each returned PDF page to about this size')
+    parser.add_argument('--concurrency', type=int, default=0,
+                        help='pages rendered at once, 0 means unlimited')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    server = make_server(args.host, args.port, args.latency, args.jitter,
+                         args.error_rate, args.page_bytes, args.concurrency)
+    logging.info('Fake html2pdf listening on %s:%d', args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+class FakeHtml2PdfTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = make_server('127.0.0.1', 0, 0.0, 0.0, 0.0, 1000)
+        self.url = 'http://127.0.0.1:%d/html2pdf' % self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_pdf_is_mergeable(self):
+        resp = requests.post(self.url, {'url': 'data:image/svg+xml;base64,'})
+        self.assertEqual(resp.status_code, 200)
+        merger = PdfFileMerger()
+        merger.append(io.BytesIO(resp.content))
+        merger.append(io.BytesIO(resp.content))
+        with io.BytesIO() as fout:
+            merger.write(fout)
+            self.assertTrue(fout.getvalue().startswith(b'%PDF'))
+
+    def test_missing_url(self):
+        resp = requests.post(self.url, {})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_errors(self):
+        self.server.RequestHandlerClass.error_rate = 1.0
+        resp = requests.post(self.url, {'url': 'x'})
+        self.assertEqual(resp.status_code, 500)
+
+
+if __name__ == '__main__':
+    main()
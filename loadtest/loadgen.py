@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import json
+import math
+import os
+import random
+import threading
+import time
+import unittest
+import unittest.mock
+
+import requests
+import urllib3
+
+__doc__ = '''
+Replays a realistic mix of /gen_strokes requests against a running Strokes
+instance and reports throughput, latency percentiles and memory used by
+each server worker.
+
+Typical laptop setup (three terminals):
+
+    python3 loadtest/fake_html2pdf.py --port 4000 --latency 0.5
+    HTML2PDF_URL=http://localhost:4000 gunicorn -c gunicorn.conf.py strokes:app
+    python3 loadtest/loadgen.py --url http://localhost:5000 -c 8 \\
+        --duration 60 --server-pid $(pgrep -of 'gunicorn -c')
+
+Or, with Docker, `docker-compose -f docker-compose.yml -f
+loadtest/docker-compose.loadtest.yml up` replaces html2pdf with the fake.
+
+Characters are taken from the official HSK lists, which are not shipped with
+the repository. Download them from
+
+    http://data.hskhsk.com/lists/HSK%20Official%202012%20L1.txt
+
+(L1 to L6) into a directory and pass it as --hsk-dir. Without them, a small
+built-in sample of HSK1 characters is repeated to the size of each level.
+
+Memory is read from /proc, so --server-pid only works on Linux. Use --json
+to save the report, e.g. for comparing two commits.
+'''
+
+# number of characters in each level of the 2012 HSK lists
+HSK_LEVEL_SIZES = {1: 174, 2: 173, 3: 270, 4: 447, 5: 621, 6: 978}
+HSK1_SAMPLE = '一七三上下不东个中么九习书买了二五些京亮人什'
+
+# "weight:value" pairs describing the default request mix
+DEFAULT_ACTIONS = 'preview_small:60,preview_large:10,generate:30'
+DEFAULT_LEVELS = '1:50,2:25,3:15,4:7,5:2,6:1'
+DEFAULT_SCALES = '100:70,50:10,150:15,200:5'
+DEFAULT_NRS = '1:70,0:20,2:10'
+
+
+def parse_weights(spec, convert=str):
+    """Parses "a:3,b:1" into ([a, b], [3, 1])."""
+    values, weights = [], []
+    for item in spec.split(','):
+        value, weight = item.rsplit(':', 1)
+        values.append(convert(value))
+        weights.append(float(weight))
+    return values, weights
+
+
+def load_levels(hsk_dir):
+    levels = {}
+    for level, size in HSK_LEVEL_SIZES.items():
+        if hsk_dir is None:
+            repeats = size // len(HSK1_SAMPLE) + 1
+            levels[level] = (HSK1_SAMPLE * repeats)[:size]
+            continue
+        path = os.path.join(hsk_dir, 'HSK Official 2012 L%d.txt' % level)
+        with open(path, encoding='utf-8-sig') as f:
+            levels[level] = ''.join(f.read().split())
+    return levels
+
+
+class RequestMix:
+    """Draws random /gen_strokes query strings. Most people only paste a
+    part of a list, so each request takes a random window of up to
+    max_chars characters from the chosen level."""
+
+    def __init__(self, levels, actions, level_weights, scales, nrs,
+                 max_chars, seed=None):
+        self.levels = levels
+        self.actions = actions
+        self.level_weights = level_weights
+        self.scales = scales
+        self.nrs = nrs
+        self.max_chars = max_chars
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def pick(self, values_weights):
+        return self.rng.choices(*values_weights)[0]
+
+    def next_query(self):
+        with self.lock:
+            chars = self.levels[self.pick(self.level_weights)]
+            length = self.rng.randint(1, min(self.max_chars, len(chars)))
+            start = self.rng.randint(0, len(chars) - length)
+            return {
+                'action': self.pick(self.actions),
+                'chars': chars[start:start + length],
+                'scale': self.pick(self.scales),
+                'nr': self.pick(self.nrs),
+            }
+
+
+def read_memory(pid):
+    """Returns (rss, pss) of given process in kB."""
+    ret = {}
+    with open('/proc/%d/smaps_rollup' % pid) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('Rss', 'Pss'):
+                ret[key] = int(value.split()[0])
+    return ret['Rss'], ret['Pss']
+
+
+def list_children(pid):
+    with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+        return [int(x) for x in f.read().split()]
+
+
+class MemorySampler(threading.Thread):
+    """Periodically records peak memory of the server's master process and
+    each of its workers."""
+
+    def __init__(self, master_pid, interval=1.0):
+        super().__init__(daemon=True)
+        self.master_pid = master_pid
+        self.interval = interval
+        self.peaks = {}
+        self.stopped = threading.Event()
+
+    def sample(self):
+        for pid in [self.master_pid] + list_children(self.master_pid):
+            try:
+                rss, pss = read_memory(pid)
+            except FileNotFoundError:
+                continue  # worker got restarted in the meantime
+            peak_rss, peak_pss = self.peaks.get(pid, (0, 0))
+            self.peaks[pid] = (max(rss, peak_rss), max(pss, peak_pss))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def worker(url, mix, deadline, remaining, results, timeout):
+    session = requests.Session()
+    while time.time() < deadline:
+        with remaining['lock']:
+            if remaining['n'] == 0:
+                return
+            remaining['n'] -= 1
+        query = mix.next_query()
+        start = time.perf_counter()
+        try:
+            resp = session.get(url + '/gen_strokes', params=query,
+                               stream=True, timeout=timeout)
+            ttfb = resp.elapsed.total_seconds()
+            wire_bytes = len(resp.raw.read(decode_content=False))
+            status = resp.status_code
+        # reading the raw body bypasses requests' exception wrapping, so a
+        # dropped connection surfaces as a bare urllib3 error
+        except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+            ttfb, wire_bytes, status = None, 0, type(e).__name__
+        results.append({
+            'action': query['action'],
+            'nchars': len(query['chars']),
+            'status': status,
+            'ttfb': ttfb,
+            'latency': time.perf_counter() - start,
+            'bytes': wire_bytes,
+        })
+
+
+def summarize(results, wall_time):
+    def latencies(rs):
+        lat = sorted(r['latency'] for r in rs)
+        ret = {'count': len(rs)}
+        for p in (50, 90, 99):
+            ret['p%d' % p] = percentile(lat, p)
+        ret['max'] = lat[-1] if lat else None
+        return ret
+
+    by_action = collections.defaultdict(list)
+    for r in results:
+        by_action[r['action']].append(r)
+    ok = [r for r in results if r['status'] == 200]
+    return {
+        'requests': len(results),
+        'wall_time': wall_time,
+        'throughput': len(results) / wall_time if wall_time else 0.0,
+        'statuses': dict(collections.Counter(
+            str(r['status']) for r in results)),
+        'bytes_received': sum(r['bytes'] for r in results),
+        'latency': latencies(ok),
+        'ttfb_p99': percentile(sorted(r['ttfb'] for r in ok), 99),
+        'by_action': {a: latencies([r for r in rs if r['status'] == 200])
+                      for a, rs in sorted(by_action.items())},
+    }
+
+
+def print_report(summary):
+    def ms(seconds):
+        return '-' if seconds is None else '%.0f ms' % (seconds * 1000)
+
+    print('requests:   %d in %.1f s (%.2f req/s)' % (
+        summary['requests'], summary['wall_time'], summary['throughput']))
+    print('statuses:   %s' % ', '.join(
+        '%s: %d' % kv for kv in sorted(summary['statuses'].items())))
+    print('received:   %.1f MB' % (summary['bytes_received'] / 1e6))
+    print('TTFB p99:   %s' % ms(summary['ttfb_p99']))
+    print()
+    print('%-15s %6s %9s %9s %9s %9s' % (
+        'latency (200)', 'count', 'p50', 'p90', 'p99', 'max'))
+    rows = [('all', summary['latency'])] + list(
+        summary['by_action'].items())
+    for name, lat in rows:
+        print('%-15s %6d %9s %9s %9s %9s' % (
+            name, lat['count'], ms(lat['p50']), ms(lat['p90']),
+            ms(lat['p99']), ms(lat['max'])))
+    if 'memory' in summary:
+        print()
+        print('%-10s %12s %12s' % ('peak mem', 'RSS', 'PSS'))
+        for pid, (rss, pss) in sorted(summary['memory'].items()):
+            print('%-10s %9d kB %9d kB' % (pid, rss, pss))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load generator for the Strokes /gen_strokes endpoint.')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('-c', '--concurrency', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help='stop after this many seconds (default: 30)')
+    parser.add_argument('-n', '--requests', type=int, default=-1,
+                        help='stop after this many requests')
+    parser.add_argument('--timeout', type=float, default=600.0)
+    parser.add_argument('--hsk-dir', help='directory with HSK list files')
+    parser.add_argument('--max-chars', type=int, default=40,
+                        help='longest character window sent in one request')
+    parser.add_argument('--actions', default=DEFAULT_ACTIONS)
+    parser.add_argument('--levels', default=DEFAULT_LEVELS)
+    parser.add_argument('--scales', default=DEFAULT_SCALES)
+    parser.add_argument('--nrs', default=DEFAULT_NRS)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--server-pid', type=int,
+                        help='master PID of the server, to sample memory')
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    mix = RequestMix(load_levels(args.hsk_dir),
+                     parse_weights(args.actions),
+                     parse_weights(args.levels, int),
+                     parse_weights(args.scales, int),
+                     parse_weights(args.nrs, int),
+                     args.max_chars, args.seed)
+
+    sampler = None
+    if args.server_pid:
+        sampler = MemorySampler(args.server_pid)
+        sampler.start()
+
+    results = []
+    remaining = {'n': args.requests, 'lock': threading.Lock()}
+    start = time.time()
+    threads = [threading.Thread(target=worker, args=(
+        args.url.rstrip('/'), mix, start + args.duration, remaining,
+        results, args.timeout)) for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    summary = summarize(results, time.time() - start)
+    if sampler is not None:
+        sampler.stop()
+        summary['memory'] = sampler.peaks
+    print_report(summary)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+class LoadgenTest(unittest.TestCase):
+
+    def test_parse_weights(self):
+        self.assertEqual(parse_weights('100:7,50:3', int),
+                         ([100, 50], [7.0, 3.0]))
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([5], 99), 5)
+        self.assertIsNone(percentile([], 50))
+
+    def test_builtin_levels(self):
+        levels = load_levels(None)
+        for level, size in HSK_LEVEL_SIZES.items():
+            self.assertEqual(len(levels[level]), size)
+
+    def test_mix_window(self):
+        mix = RequestMix({1: 'abcdef'}, (['generate'], [1]), ([1], [1]),
+                         ([100], [1]), ([1], [1]), 3, seed=1)
+        for _ in range(20):
+            query = mix.next_query()
+            self.assertIn(query['chars'], 'abcdef')
+            self.assertTrue(1 <= len(query['chars']) <= 3)
+
+    @unittest.mock.patch('requests.Session.get')
+    def test_worker_truncated_body(self, get):
+        error = urllib3.exceptions.ProtocolError('Connection broken')
+        get.return_value.raw.read.side_effect = error
+        mix = RequestMix({1: 'abc'}, (['generate'], [1]), ([1], [1]),
+                         ([100], [1]), ([1], [1]), 3, seed=1)
+        remaining = {'n': 1, 'lock': threading.Lock()}
+        results = []
+        worker('http://x', mix, time.time() + 60, remaining, results, 1.0)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['status'], 'ProtocolError')
+        self.assertEqual(results[0]['bytes'], 0)
+
+    def test_summarize(self):
+        results = [
+            {'action': 'generate', 'status': 200, 'latency': 1.0,
+             'ttfb': 0.5, 'bytes': 10, 'nchars': 1},
+            {'action': 'generate', 'status': 500, 'latency': 9.0,
+             'ttfb': 0.1, 'bytes': 5, 'nchars': 1},
+        ]
+        summary = summarize(results, 2.0)
+        self.assertEqual(summary['throughput'], 1.0)
+        self.assertEqual(summary['statuses'], {'200': 1, '500': 1})
+        self.assertEqual(summary['latency']['max'], 1.0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,34 @@
 #!/usr/bin/env python3
 
+import argparse
 import base64
 import collections
+import contextlib
+import functools
+import hashlib
 import io
 import json
+import multiprocessing
 import os
 import random
+import re
+import tempfile
 import unicodedata
 import unittest
 import unittest.mock
+import urllib.parse
+import zlib
 
 import requests
 
+try:
+    import brotli
+except ImportError:  # brotli is optional, we fall back to gzip without it
+    brotli = None
+
 from PyPDF2 import PdfFileMerger
-from flask import Flask, Response, request
+from PyPDF2.errors import PdfReadError
+from flask import Flask, Response, jsonify, request
 
 __doc__ = '''
 Generates a file that can be used for learning how to write a specific
@@ -64,6 +79,10 @@ PAGE_SIZE = (200, 300)
 CHUNK_SIZE = 4
 LINE_THICK = 30
 
+# Strip the indentation from SVG templates before sending them. Set
+# STROKES_MINIFY_SVG=0 to get the human-readable output back for debugging.
+MINIFY_SVG = os.environ.get('STROKES_MINIFY_SVG', '1') != '0'
+
 
 def load_strokes_db(graphics_txt_path):
     ret = {}
@@ -88,6 +107,255 @@ STROKES_DB = load_strokes_db('graphics.txt')
 PINYIN_DB = load_dictionary('dictionary.txt')
 
 
+def split_codes(value, strip='.'):
+    """wiktionary-data.json sometimes lists alternatives, e.g. "KNH,KSH",
+    "17430/17804" or "7 or 8". Returns all of them."""
+    for c in strip:
+        value = value.replace(c, '')
+    return [x for x in re.split(r'[,/ ]|or', value) if x]
+
+
+def parse_ids(ids):
+    """Returns the set of components of an IDS decomposition, dropping the
+    description characters (⿰, ⿱, ...) and wiki markup around them."""
+    ids = re.sub(r'<!--.*|<[^>]*>|\([^)]*\)', '', ids)
+    return {c for c in ids if ord(c) >= 0x2E80
+            and not 0x2FF0 <= ord(c) <= 0x2FFF
+            and not 0x3000 <= ord(c) <= 0x303F}
+
+
+CharEntry = collections.namedtuple(
+    'CharEntry', 'radical radical_number strokes cangjie four components')
+
+
+class CharIndex:
+    """Inverted indexes over wiktionary-data.json, used by /lookup.
+
+    For each field and each value it could be queried with, we precompute the
+    string of matching characters, ordered by stroke count, so that
+    a single-field query is just a dict lookup no matter how many characters
+    it returns. Codes (cangjie,
+    four-corner) are indexed by every prefix and IDS components recursively,
+    so that e.g. 口 finds 器 even though it's not listed as its direct part.
+
+    Only characters that gen_strokes can draw are returned, which means the
+    results can be passed straight to it as "chars"."""
+
+    FIELDS = ('radical', 'strokes', 'cangjie', 'four', 'component')
+
+    def __init__(self, entries, drawable):
+        # Only keep what describe() needs, packed into a single string per
+        # character - the raw entries take several times more memory.
+        self.entries = {}
+        for C, e in entries.items():
+            components = ''.join(sorted(parse_ids(e.get('ids', '')) - {C}))
+            self.entries[C] = '\t'.join([
+                e['rad'], e['rn'], e.get('sn', ''), e.get('canj', ''),
+                e.get('four', ''), components])
+
+        # walking the characters in order means postings come out sorted
+        ordered = sorted((C for C in self.entries if C in drawable),
+                         key=self.sort_key)
+        postings = {field: collections.defaultdict(list)
+                    for field in self.FIELDS}
+        for C in ordered:
+            for field in self.FIELDS:
+                for key in self.keys(field, C):
+                    postings[field][key].append(C)
+
+        self.index = {field: {key: ''.join(chars)
+                              for key, chars in by_key.items()}
+                      for field, by_key in postings.items()}
+
+    @classmethod
+    def from_json(cls, path, drawable):
+        with open(path, 'r', encoding='utf8') as f:
+            return cls(json.load(f), drawable)
+
+    def entry(self, C):
+        return CharEntry(*self.entries[C].split('\t'))
+
+    def sort_key(self, C):
+        strokes = split_codes(self.entry(C).strokes)
+        return (int(strokes[0]) if strokes else 99, C)
+
+    def components(self, C):
+        """All components of C, recursively. Walks the decompositions with
+        a stack, because some of them are cyclic."""
+        ret = set()
+        stack = list(self.entry(C).components)
+        while stack:
+            part = stack.pop()
+            if part in ret or part == C:
+                continue
+            ret.add(part)
+            if part in self.entries:
+                stack.extend(self.entry(part).components)
+        return ret
+
+    def keys(self, field, C):
+        e = self.entry(C)
+        if field == 'radical':
+            return [e.radical, e.radical_number]
+        if field == 'strokes':
+            return split_codes(e.strokes)
+        if field == 'component':
+            return self.components(C)
+        codes = split_codes(e.cangjie if field == 'cangjie' else e.four)
+        return {code[:n] for code in codes for n in range(1, len(code) + 1)}
+
+    @staticmethod
+    def normalize(field, value):
+        if field == 'cangjie':
+            return value.upper()
+        if field == 'four':
+            return value.replace('.', '')
+        return value.strip()
+
+    def search(self, query):
+        """Returns the characters matching all fields in query, ordered by
+        stroke count. Raises ValueError on unknown fields."""
+        hits = []
+        for field, value in query.items():
+            if field not in self.index:
+                raise ValueError('Unknown field: %r' % field)
+            hit = self.index[field].get(self.normalize(field, value))
+            if hit is None:
+                return ''
+            hits.append(hit)
+        if not hits:
+            return ''
+        if len(hits) == 1:
+            return hits[0]
+        # all postings are ordered the same way, so we can just filter the
+        # shortest one
+        hits.sort(key=len)
+        chars = set(hits[0])
+        for hit in hits[1:]:
+            chars.intersection_update(hit)
+        return ''.join([C for C in hits[0] if C in chars])
+
+    def describe(self, C):
+        e = self.entry(C)
+        return {
+            'char': C,
+            'radical': e.radical,
+            'radical_number': e.radical_number,
+            'strokes': [int(x) for x in split_codes(e.strokes)],
+            'cangjie': split_codes(e.cangjie),
+            'four': split_codes(e.four),
+            'components': list(e.components),
+            'drawable': C in STROKES_DB and C in PINYIN_DB,
+        }
+
+
+class CharIndexTest(unittest.TestCase):
+
+    ENTRIES = {
+        '女': {'rn': '38', 'rad': '女', 'sn': '3', 'four': '40400',
+              'canj': 'V'},
+        '子': {'rn': '39', 'rad': '子', 'sn': '3', 'four': '17407',
+              'canj': 'ND', 'ids': '⿻了一'},
+        '好': {'rn': '38', 'rad': '女', 'sn': '6', 'four': '47447',
+              'canj': 'VND', 'ids': '⿰女子'},
+        '妈': {'rn': '38', 'rad': '女', 'sn': '6', 'four': '',
+              'canj': 'VNVM', 'ids': '⿰女马 <small>(G)</small>'},
+        '马': {'rn': '187', 'rad': '馬', 'sn': '3', 'four': '',
+              'canj': 'NVSM,NLVM', 'ids': '⿹[[𠃍]]一 (GT)'},
+        # a cycle: 甲 -> 乙 -> 丙 -> 乙, and 甲 listing itself
+        '甲': {'rn': '1', 'rad': '一', 'sn': '5', 'canj': 'A',
+              'ids': '⿱乙甲'},
+        '乙': {'rn': '1', 'rad': '一', 'sn': '1', 'canj': 'B',
+              'ids': '⿰丙口'},
+        '丙': {'rn': '1', 'rad': '一', 'sn': '5', 'canj': 'C',
+              'ids': '⿰乙木'},
+    }
+
+    def setUp(self):
+        self.index = CharIndex(self.ENTRIES, {'女', '子', '好', '妈', '甲',
+                                              '乙', '丙'})
+
+    def test_radical(self):
+        self.assertEqual(self.index.search({'radical': '女'}), '女好妈')
+        self.assertEqual(self.index.search({'radical': '38'}), '女好妈')
+
+    def test_cangjie_prefix(self):
+        self.assertEqual(self.index.search({'cangjie': 'vn'}), '好妈')
+        self.assertEqual(self.index.search({'cangjie': 'VND'}), '好')
+
+    def test_four_corner(self):
+        self.assertEqual(self.index.search({'four': '4'}), '女好')
+        self.assertEqual(self.index.search({'four': '1740.7'}), '子')
+
+    def test_components_are_recursive(self):
+        self.assertEqual(self.index.search({'component': '子'}), '好')
+        self.assertEqual(self.index.search({'component': '一'}), '子好妈')
+
+    def test_cyclic_components(self):
+        self.assertEqual(self.index.components('甲'), {'乙', '丙', '口', '木'})
+        self.assertEqual(self.index.components('丙'), {'乙', '口', '木'})
+        self.assertEqual(self.index.search({'component': '木'}), '乙丙甲')
+        self.assertEqual(self.index.search({'component': '甲'}), '')
+
+    def test_html_comment_in_ids(self):
+        index = CharIndex({'亲': {'rn': '117', 'rad': '立', 'sn': '9',
+                                 'ids': '⿱立朩(GV),⿱立木(JK)}} <!-- Unicode '
+                                 'lists only ⿱立朩(G). The addition of '
+                                 '⿱立木(JK) is based on 新,親 -'}}, {'亲'})
+        self.assertEqual(index.describe('亲')['components'], ['木', '朩', '立'])
+
+    def test_not_drawable(self):
+        self.assertEqual(self.index.search({'cangjie': 'NL'}), '')
+
+    def test_intersection(self):
+        query = {'radical': '女', 'strokes': '6', 'component': '马'}
+        self.assertEqual(self.index.search(query), '妈')
+        self.assertEqual(self.index.search({'radical': '女', 'four': '1'}),
+                         '')
+
+    def test_unknown_field(self):
+        with self.assertRaises(ValueError):
+            self.index.search({'pinyin': 'hao'})
+
+    def test_empty_query(self):
+        self.assertEqual(self.index.search({}), '')
+
+    def test_split_codes(self):
+        self.assertEqual(split_codes('7 or 8'), ['7', '8'])
+        self.assertEqual(split_codes('3010.0/17804'), ['30100', '17804'])
+
+
+CHAR_INDEX = CharIndex.from_json('wiktionary-data.json',
+                                 STROKES_DB.keys() & PINYIN_DB.keys())
+
+
+def minify_svg(code):
+    """Collapses whitespace in SVG template code. Whitespace between tags and
+    inside them is insignificant, so the output renders exactly the same."""
+    code = re.sub(r'>\s+<', '><', code.strip())
+    code = re.sub(r'\s*\n\s*>', '>', code)
+    return re.sub(r'\s+', ' ', code)
+
+
+class MinifySvgTest(unittest.TestCase):
+
+    def test_no_newlines(self):
+        self.assertNotIn('\n', minify_svg(Tile.PREAMBLE))
+        self.assertNotIn('\n', minify_svg(Header.TEXT_TPL))
+
+    def test_same_tokens(self):
+        self.assertEqual(minify_svg(Page.HEADER_SINGLE).split(),
+                         Page.HEADER_SINGLE.split())
+
+    def test_unminified_pages(self):
+        pages = gen_svgs(15, iter(gen_images('一', 1)), minify=False)
+        self.assertIn('\n', pages[0].f.getvalue())
+
+    def test_tag_boundaries(self):
+        self.assertEqual(minify_svg('<g>\n  <line\n    x="1"\n  ></line>'),
+                         '<g><line x="1"></line>')
+
+
 class Tile:
     """Class responsible for preparing SVG code describing a single tine.
 
@@ -120,8 +388,16 @@ class Tile:
     PATH_TPL = '''<path d="%s" stroke="black" stroke-width="%d"
         fill="white"></path>'''
 
+    TEXT_TPL = '''<text x="50" y="950"
+            font-size="250px">%s</text>'''
+
     FOOTER = '''</g></svg></svg>'''
 
+    SVG_HEADER_MIN = minify_svg(SVG_HEADER)
+    PREAMBLE_MIN = minify_svg(PREAMBLE)
+    PATH_TPL_MIN = minify_svg(PATH_TPL)
+    TEXT_TPL_MIN = minify_svg(TEXT_TPL)
+
     def __init__(self, C, chunk, strokes, highlight_until, skip_strokes,
                  stop_at, add_pinyin=True, skip_in_header=False,
                  add_radical=False):
@@ -146,7 +422,15 @@ class Tile:
         self.y = y
         self.size = size
 
-    def render(self):
+    def render(self, minify=False):
+
+        if minify:
+            templates = (self.SVG_HEADER_MIN, self.TEXT_TPL_MIN,
+                         self.PREAMBLE_MIN, self.PATH_TPL_MIN)
+        else:
+            templates = (self.SVG_HEADER, self.TEXT_TPL, self.PREAMBLE,
+                         self.PATH_TPL)
+        header_tpl, text_tpl, preamble_tpl, path_tpl = templates
 
         if not all([self.size, self.y, self.size]):
             raise RuntimeError("Call set_dimensions first!")
@@ -158,23 +442,22 @@ class Tile:
             add_text = db_entry['pinyin'][0]
             if self.add_radical:
                 add_text += db_entry['radical']
-        add_text_svg = ('''<text x="50" y="950"
-            font-size="250px">%s</text>''' % add_text)
+        add_text_svg = text_tpl % add_text
         header_args = {'x': self.x, 'y': self.y, 'size': self.size}
         preamble_args = {'leftline_width': self.leftline_width,
                          'topline_width': self.topline_width}
 
         with io.StringIO() as f:
 
-            f.write(''.join([self.SVG_HEADER % header_args, add_text_svg,
-                             self.PREAMBLE % preamble_args]))
+            f.write(''.join([header_tpl % header_args, add_text_svg,
+                             preamble_tpl % preamble_args]))
             for n, stroke in enumerate(self.strokes):
                 if n < self.skip_strokes or n >= self.stop_at:
                     continue
                 # IMHO this can safely be hardcoded because it's relative
                 # to this image
                 line_size = (20 if n - 1 < self.highlight_until else 10)
-                f.write(self.PATH_TPL % (stroke, line_size))
+                f.write(path_tpl % (stroke, line_size))
             f.write(self.FOOTER)
             return f.getvalue()
 
@@ -255,6 +538,11 @@ class Header:
     """The responsibility of this class is to manage the header - i.e. make
     sure it's split into two lines."""
 
+    TEXT_TPL = '''<text x="0" y="5" font-size="5px"><tspan x="0" dy="0em"
+            >%d: %s</tspan></text>'''
+
+    TEXT_TPL_MIN = minify_svg(TEXT_TPL)
+
     def __init__(self):
         self.header = ''
         self.chars_drawn = []
@@ -273,9 +561,9 @@ class Header:
         self.header += PINYIN_DB[C]['radical']
         self.header += ')'
 
-    def get_text(self, page_drawn):
-        return '''<text x="0" y="5" font-size="5px"><tspan x="0" dy="0em"
-            >%d: %s</tspan></text>''' % (page_drawn, self.header)
+    def get_text(self, page_drawn, minify=False):
+        text_tpl = self.TEXT_TPL_MIN if minify else self.TEXT_TPL
+        return text_tpl % (page_drawn, self.header)
 
 
 class Page:
@@ -284,10 +572,13 @@ class Page:
     version="1.1" xmlns="http://www.w3.org/2000/svg"
     xmlns:xlink="http://www.w3.org/1999/xlink">''' % PAGE_SIZE
 
+    HEADER_SINGLE_MIN = minify_svg(HEADER_SINGLE)
+
     FOOTER_SINGLE = '</svg>'
 
-    def __init__(self, page_drawn, tile_size, gen_images_iter):
+    def __init__(self, page_drawn, tile_size, gen_images_iter, minify=False):
         self.page_drawn = page_drawn
+        self.minify = minify
         self.tiles_by_pos = collections.defaultdict(dict)
         self.hdr = Header()
         self.tile_size = tile_size
@@ -335,7 +626,7 @@ class Page:
 
             self.maybe_draw_border(tile, row_num, col_num)
 
-            f.write(tile.render())
+            f.write(tile.render(self.minify))
 
         return True
 
@@ -343,29 +634,37 @@ class Page:
         """Renders the page and returns a boolean that tells whether it was
         the last one."""
 
-        self.f.write(self.HEADER_SINGLE)
+        if self.minify:
+            self.f.write(self.HEADER_SINGLE_MIN)
+        else:
+            self.f.write(self.HEADER_SINGLE)
         try:
             self.write_tiles(self.f)
         finally:
             # in the last page, we will get StopIteration. Regardless of it,
             # We need to finalize rendering.
-            self.f.write(self.hdr.get_text(self.page_drawn))
+            self.f.write(self.hdr.get_text(self.page_drawn, self.minify))
             self.f.write(self.FOOTER_SINGLE)
 
 
-def gen_svgs(size, gen_images_iter):
+def gen_svgs_iter(size, gen_images_iter, minify=False):
+    """Renders pages lazily, so that the preview can be streamed to the
+    client while the following pages are still being drawn."""
 
-    pages = []
     page_drawn = 0
     while True:
         page_drawn += 1
-        page = Page(page_drawn, size, gen_images_iter)
-        pages.append(page)
+        page = Page(page_drawn, size, gen_images_iter, minify)
         try:
             page.prepare()
         except StopIteration:
-            break
-    return pages
+            yield page
+            return
+        yield page
+
+
+def gen_svgs(size, gen_images_iter, minify=False):
+    return list(gen_svgs_iter(size, gen_images_iter, minify))
 
 
 def gen_pdf(svg_code):
@@ -374,6 +673,7 @@ def gen_pdf(svg_code):
     htmlpdf_host = os.environ.get('HTML2PDF_URL', 'http://html2pdf:5000')
     gen_url = '%s/html2pdf' % htmlpdf_host
     resp = requests.post(gen_url, {'url': datauri})
+    resp.raise_for_status()
     return resp.content
 
 
@@ -396,19 +696,76 @@ def gen_pdfs(pages):
             pdf_f.close()
 
 
-def gen_html(pages, small=True):
+def gen_html_iter(pages, small=True):
     # just put together the stream of SVG images
-    body = ['<body>']
+    yield '<body>'
     for page in pages:
         svg_code = page.f.getvalue()
         if small:
-            body.append(svg_code)
+            yield svg_code
             continue
         # The following zooms the images in, but doesn't allow zooming out
         data_b64 = base64.b64encode(svg_code.encode('utf8')).decode('ascii')
         datauri = 'data:image/svg+xml;base64,%s' % data_b64
-        body.append('<img src="%s" />' % datauri)
-    return ''.join(body)
+        yield '<img src="%s" />' % datauri
+
+
+def gen_html(pages, small=True):
+    return ''.join(gen_html_iter(pages, small))
+
+
+def supported_encodings():
+    if brotli is not None:
+        return ['br', 'gzip']
+    return ['gzip']
+
+
+def pick_encoding(accept_encodings):
+    """Returns the best Content-Encoding we can produce for given werkzeug
+    Accept object or None if the client only takes identity."""
+    return accept_encodings.best_match(supported_encodings())
+
+
+def new_compressor(encoding):
+    """Returns a (compress, flush, finish) tuple of callables that wrap the
+    streaming API of zlib or brotli."""
+    if encoding == 'gzip':
+        c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return c.compress, lambda: c.flush(zlib.Z_SYNC_FLUSH), c.flush
+    if encoding == 'br':
+        c = brotli.Compressor(quality=5)
+        return c.process, c.flush, c.finish
+    raise ValueError('Unknown encoding: %r' % encoding)
+
+
+def compress(data, encoding):
+    compress_chunk, _, finish = new_compressor(encoding)
+    return compress_chunk(data) + finish()
+
+
+def compress_iter(chunks, encoding=None):
+    """Encodes the stream of text chunks, compressing it on the fly if
+    encoding is given. Each chunk is flushed, so the client can start rendering
+    the first page before we're done with the rest."""
+    if encoding is None:
+        for chunk in chunks:
+            yield chunk.encode('utf8')
+        return
+    compress_chunk, flush, finish = new_compressor(encoding)
+    for chunk in chunks:
+        yield compress_chunk(chunk.encode('utf8')) + flush()
+    yield finish()
+
+
+class CompressTest(unittest.TestCase):
+
+    def test_unknown_encoding(self):
+        with self.assertRaises(ValueError):
+            new_compressor('deflate')
+
+    @unittest.mock.patch.dict(globals(), {'brotli': None})
+    def test_gzip_without_brotli(self):
+        self.assertEqual(supported_encodings(), ['gzip'])
 
 
 def pinyin_sortable(chinese_character):
@@ -470,17 +827,34 @@ def sort_input(input_characters, sorting, nodupes):
         raise ValueError('Unknown sort mode: %r' % sorting)
 
 
-def draw(input_characters, size, num_repeats, action):
+def tile_size(scale):
+    return int(15 * scale / 100.0)
+
+
+def check_characters(input_characters):
+    """Raises KeyError for the first character we can't draw. This has to
+    happen before we start streaming, otherwise we'd already have sent
+    "200 OK" by the time we find out."""
+    for C in input_characters:
+        if C not in STROKES_DB or C not in PINYIN_DB:
+            raise KeyError(C)
 
+
+def draw(input_characters, size, num_repeats, action, encoding=None):
+
+    check_characters(input_characters)
     gen_images_iter = iter(gen_images(input_characters, num_repeats))
-    pages = gen_svgs(size, gen_images_iter)
+    pages = gen_svgs_iter(size, gen_images_iter, MINIFY_SVG)
 
     if action == 'generate':
         return [gen_pdfs(pages)], {'mimetype': 'application/pdf'}
-    if action == 'preview_small':
-        return [gen_html(pages)], {'mimetype': 'text/html'}
-    if action == 'preview_large':
-        return [gen_html(pages, False)], {'mimetype': 'text/html'}
+    if action in ('preview_small', 'preview_large'):
+        small = action == 'preview_small'
+        body = compress_iter(gen_html_iter(pages, small), encoding)
+        headers = {'Vary': 'Accept-Encoding'}
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        return [body], {'mimetype': 'text/html', 'headers': headers}
     body = '<h1>Invalid action: %r</h1>' % action
     return [body], {'mimetype': 'text/html', 'status': 400}
 
@@ -501,7 +875,7 @@ def gen_strokes():
     except ValueError:
         err = 'Invalid tile scale: %r (should be a number)' % scale_s
         return ret_error(err)
-    size = int(15 * scale / 100.0)
+    size = tile_size(scale)
 
     num_repetitions_s = form_d.pop('nr', '1') or '1'
     try:
@@ -528,16 +902,38 @@ def gen_strokes():
     except ValueError:
         return ret_error('Unexpected sorting: %r' % sort_mode)
 
+    encoding = pick_encoding(request.accept_encodings)
     try:
-        resp_args, resp_kwargs = draw(C, size, num_repetitions, action)
+        resp_args, resp_kwargs = draw(C, size, num_repetitions, action,
+                                      encoding)
     except KeyError as e:
         resp_args = ['<h1>Unknown character: %r</h1>' % e.args[0]]
         resp_kwargs = {'status': 400, 'mimetype': 'text/html'}
     return Response(*resp_args, **resp_kwargs)
 
 
-@app.route('/')
-def index():
+@app.route('/lookup')
+def lookup():
+    query = dict(request.args)
+    if not query:
+        return jsonify(error='Specify at least one of: %s' % ', '.join(
+            CharIndex.FIELDS)), 400
+    try:
+        chars = CHAR_INDEX.search(query)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(chars=chars, count=len(chars))
+
+
+@app.route('/lookup/<C>')
+def lookup_char(C):
+    if C not in CHAR_INDEX.entries:
+        return jsonify(error='Unknown character: %r' % C), 404
+    return jsonify(CHAR_INDEX.describe(C))
+
+
+@functools.lru_cache()
+def render_index():
     git_version = ''
     try:
         with open('commit-id') as f:
@@ -627,6 +1023,299 @@ href="https://stackpath.bootstrapcdn.com/bootswatch/4.1.2/cerulean/bootstrap.min
 </html>''' % git_version
 
 
+@functools.lru_cache()
+def render_index_compressed(encoding):
+    """The index page never changes while we're running, so we only compress
+    it once per encoding."""
+    return compress(render_index().encode('utf8'), encoding)
+
+
+def warm_caches():
+    """Fills in the caches before the server forks, so that workers share
+    them instead of each computing its own copy. See gunicorn.conf.py."""
+    render_index()
+    for encoding in supported_encodings():
+        render_index_compressed(encoding)
+
+
+class WarmCachesTest(unittest.TestCase):
+
+    def test_index_cached(self):
+        warm_caches()
+        self.assertEqual(render_index.cache_info().currsize, 1)
+        self.assertEqual(render_index_compressed.cache_info().currsize,
+                         len(supported_encodings()))
+
+
+@app.route('/')
+def index():
+    encoding = pick_encoding(request.accept_encodings)
+    resp_kwargs = {'mimetype': 'text/html',
+                   'headers': {'Vary': 'Accept-Encoding'}}
+    if encoding is None:
+        return Response(render_index(), **resp_kwargs)
+    resp_kwargs['headers']['Content-Encoding'] = encoding
+    return Response(render_index_compressed(encoding), **resp_kwargs)
+
+
+BUILD_SPEC_DEFAULTS = {
+    'scale': 100,
+    'nr': 1,
+    'sorting': 'none',
+    'nodupes': False,
+    'actions': ['generate', 'preview_small', 'preview_large'],
+}
+
+BUILD_ACTION_SUFFIXES = {
+    'generate': '.pdf',
+    'preview_small': '.preview_small.html',
+    'preview_large': '.preview_large.html',
+}
+
+BUILD_STATE_FILE = '.strokes-build.json'
+
+
+def load_build_specs(paths):
+    """Reads worksheet specs from JSON manifests (a list of objects with
+    "name", "chars" or "chars_file" and optionally the keys of
+    BUILD_SPEC_DEFAULTS) or plain character files, which get default
+    settings and are named after the file."""
+    specs = []
+    for path in paths:
+        if not path.endswith('.json'):
+            name = os.path.splitext(os.path.basename(path))[0]
+            # "HSK Official 2012 L1.txt" becomes HSK_Official_2012_L1
+            name = re.sub(r'[^A-Za-z0-9_-]+', '_', name)
+            specs.append({'name': name, 'chars_file': path})
+            continue
+        base_dir = os.path.dirname(path)
+        with open(path, 'r', encoding='utf8') as f:
+            manifest = json.load(f)
+        if not isinstance(manifest, list) or \
+                not all(isinstance(spec, dict) for spec in manifest):
+            raise ValueError('%s: expected a list of objects' % path)
+        for spec in manifest:
+            if isinstance(spec.get('chars_file'), str):
+                spec['chars_file'] = os.path.join(base_dir,
+                                                  spec['chars_file'])
+            specs.append(spec)
+
+    ret = []
+    names = set()
+    for spec in specs:
+        unexpected = set(spec) - set(BUILD_SPEC_DEFAULTS) - {
+            'name', 'chars', 'chars_file'}
+        if unexpected:
+            raise ValueError('Unexpected keys in %r: %r' % (
+                spec.get('name'), sorted(unexpected)))
+        name = spec.get('name')
+        # names become file names in the output directory and are written
+        # unquoted into nginx.map
+        if not isinstance(name, str) or \
+                not re.fullmatch(r'[A-Za-z0-9_-]+', name):
+            raise ValueError('Invalid worksheet name: %r (use letters, '
+                             'digits, "_" and "-")' % name)
+        if name in names:
+            raise ValueError('Duplicate worksheet name: %r' % name)
+        names.add(name)
+        if ('chars' in spec) == ('chars_file' in spec):
+            raise ValueError('Worksheet %r needs either "chars" or '
+                             '"chars_file"' % name)
+        spec = dict(BUILD_SPEC_DEFAULTS, **spec)
+        check_build_spec(spec)
+        if 'chars_file' in spec:
+            with open(spec.pop('chars_file'), encoding='utf-8-sig') as f:
+                spec['chars'] = f.read()
+        spec['chars'] = ''.join(spec['chars'].split())
+        ret.append(spec)
+    return ret
+
+
+def check_build_spec(spec):
+    """Raises ValueError unless the spec's values are of the types the web
+    form would send, so that bad manifests fail before anything is built."""
+    name = spec['name']
+    for key in ('scale', 'nr'):
+        # bool is a subclass of int, but "scale": true is surely a mistake
+        if not isinstance(spec[key], int) or isinstance(spec[key], bool):
+            raise ValueError('Worksheet %r: %r must be an integer' % (
+                name, key))
+    if tile_size(spec['scale']) <= 0:
+        raise ValueError('Worksheet %r: scale %d is too small' % (
+            name, spec['scale']))
+    if spec['nr'] < 0:
+        raise ValueError('Worksheet %r: nr must not be negative' % name)
+    if not isinstance(spec['nodupes'], bool):
+        raise ValueError('Worksheet %r: nodupes must be true or false' % name)
+    for key in ('chars', 'chars_file', 'sorting'):
+        if key in spec and not isinstance(spec[key], str):
+            raise ValueError('Worksheet %r: %r must be a string' % (
+                name, key))
+    actions = spec['actions']
+    if not isinstance(actions, list) or not all(
+            isinstance(action, str) and action in BUILD_ACTION_SUFFIXES
+            for action in actions):
+        raise ValueError('Worksheet %r: actions must be a list of %s' % (
+            name, ', '.join(BUILD_ACTION_SUFFIXES)))
+
+
+def static_request_uri(spec, action):
+    """Returns the URI the index page's form would request for this spec,
+    so that nginx can map it to the pre-generated file."""
+    args = [('chars', spec['chars']), ('scale', spec['scale']),
+            ('nr', spec['nr']), ('sorting', spec['sorting'])]
+    if spec['nodupes']:
+        args.append(('nodupes', 'true'))
+    args.append(('action', action))
+    return '/gen_strokes?' + urllib.parse.urlencode(args)
+
+
+def data_version():
+    """Hash of everything that affects the output apart from the spec."""
+    h = hashlib.sha1()
+    for path in (__file__, 'graphics.txt', 'dictionary.txt'):
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def build_output_paths(path, action):
+    """Lists the files build_task writes for given action."""
+    if action == 'generate':
+        return [path]
+    if brotli is not None:
+        return [path, path + '.gz', path + '.br']
+    return [path, path + '.gz']
+
+
+def write_atomically(path, data):
+    """Writes to a temporary file first, so that neither nginx nor the next
+    build ever sees a half-written file."""
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+
+def build_task(task):
+    """Renders a single file for build_static. Runs in a worker process, so
+    it returns errors instead of raising them."""
+    spec, action, path = task
+    try:
+        C = sort_input(spec['chars'], spec['sorting'], spec['nodupes'])
+        check_characters(C)
+        gen_images_iter = iter(gen_images(C, spec['nr']))
+        pages = gen_svgs(tile_size(spec['scale']), gen_images_iter,
+                         MINIFY_SVG)
+        if action == 'generate':
+            outputs = {path: gen_pdfs(pages)}
+        else:
+            html = gen_html(pages, action == 'preview_small').encode('utf8')
+            outputs = {path: html}
+            # for nginx's gzip_static and brotli_static
+            outputs[path + '.gz'] = compress(html, 'gzip')
+            if brotli is not None:
+                outputs[path + '.br'] = compress(html, 'br')
+        for out_path, data in outputs.items():
+            write_atomically(out_path, data)
+    except KeyError as e:
+        return path, 'Unknown character: %r' % e.args[0]
+    except (ValueError, OSError, PdfReadError,
+            requests.RequestException) as e:
+        return path, '%s: %s' % (type(e).__name__, e)
+    return path, None
+
+
+def build_static(specs, out_dir, jobs=None, force=False):
+    """Pre-generates worksheets into out_dir, skipping the files whose spec,
+    code and data didn't change since the last run. Returns a dict of
+    failures (path -> error message)."""
+    os.makedirs(out_dir, exist_ok=True)
+    state_path = os.path.join(out_dir, BUILD_STATE_FILE)
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        state = {}
+
+    version = data_version()
+    tasks, fingerprints, nginx_map = [], {}, {}
+    for spec in specs:
+        for action in spec['actions']:
+            filename = spec['name'] + BUILD_ACTION_SUFFIXES[action]
+            path = os.path.join(out_dir, filename)
+            key = dict(spec, actions=action, version=version,
+                       minify=MINIFY_SVG)
+            fingerprint = hashlib.sha1(json.dumps(
+                key, sort_keys=True).encode('utf8')).hexdigest()
+            fingerprints[filename] = fingerprint
+            nginx_map[filename] = '"%s" %s;' % (
+                static_request_uri(spec, action), filename)
+            outputs = build_output_paths(path, action)
+            if force or state.get(filename) != fingerprint or \
+                    not all(map(os.path.exists, outputs)):
+                tasks.append((spec, action, path))
+
+    total = len(fingerprints)
+    if jobs == 1 or len(tasks) <= 1:
+        failed = collect_build_results(map(build_task, tasks))
+    else:
+        # forked workers share the character databases with us
+        with multiprocessing.Pool(jobs) as pool:
+            failed = collect_build_results(
+                pool.imap_unordered(build_task, tasks))
+    print('%d built, %d up to date, %d failed' % (
+        len(tasks) - len(failed), total - len(tasks), len(failed)))
+
+    # failed files get rebuilt next time and shouldn't be served meanwhile
+    for path in failed:
+        del fingerprints[os.path.basename(path)]
+        del nginx_map[os.path.basename(path)]
+    write_atomically(state_path, json.dumps(
+        fingerprints, indent=2, sort_keys=True).encode('utf8'))
+    write_atomically(os.path.join(out_dir, 'nginx.map'), ''.join(
+        line + '\n' for line in nginx_map.values()).encode('utf8'))
+    return failed
+
+
+def collect_build_results(results):
+    failed = {}
+    for path, error in results:
+        if error is not None:
+            failed[path] = error
+        print('%s %s' % ('FAILED' if error else 'built', path))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Pre-generates worksheets into a directory that can be '
+        'served by nginx, without running the web application.',
+        epilog='Files are named after the worksheet: NAME.pdf, '
+        'NAME.preview_small.html (with .gz/.br next to it) and '
+        'NAME.preview_large.html. OUT_DIR/nginx.map maps the /gen_strokes '
+        'URIs the index page would request to those files; include it in '
+        'a `map $request_uri $strokes_static {...}` block. Run it from the '
+        'directory with graphics.txt, dictionary.txt and '
+        'wiktionary-data.json.')
+    parser.add_argument('inputs', nargs='+', metavar='MANIFEST_OR_TXT',
+                        help='JSON manifest or a file with characters')
+    parser.add_argument('-o', '--out-dir', default='static')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='worker processes (default: number of CPUs)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='rebuild even if nothing changed')
+    args = parser.parse_args()
+
+    try:
+        specs = load_build_specs(args.inputs)
+    except (ValueError, OSError) as e:
+        parser.error(str(e))
+    failed = build_static(specs, args.out_dir, args.jobs, args.force)
+    for path, error in sorted(failed.items()):
+        print('%s: %s' % (path, error))
+    raise SystemExit(1 if failed else 0)
+
+
 def MINIMAL_PDF_MOCK(*_, **__):
     return base64.b64decode(b'''
         JVBERi0xLjEKJcKlwrHDqwoKMSAwIG9iagogIDw8IC9UeXBlIC9DYXRhbG9n
@@ -648,6 +1337,196 @@ def MINIMAL_PDF_MOCK(*_, **__):
         dGFydHhyZWYKNTY1CiUlRU9GCg==''')
 
 
+@unittest.mock.patch.dict(globals(), {'gen_pdf': MINIMAL_PDF_MOCK})
+class BuildStaticTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.out_dir = os.path.join(self.tmp.name, 'static')
+        self.spec = dict(BUILD_SPEC_DEFAULTS, name='digits', chars='一二三',
+                         scale=12)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def build(self, specs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return build_static(specs, self.out_dir, jobs=1)
+
+    def mtimes(self):
+        return {name: os.stat(os.path.join(self.out_dir, name)).st_mtime_ns
+                for name in os.listdir(self.out_dir)
+                if name.startswith('digits.')}
+
+    def test_builds_all_actions(self):
+        self.assertEqual(self.build([self.spec]), {})
+        files = set(os.listdir(self.out_dir))
+        for name in ['digits.pdf', 'digits.preview_small.html',
+                     'digits.preview_small.html.gz',
+                     'digits.preview_large.html', 'nginx.map']:
+            self.assertIn(name, files)
+        with open(os.path.join(self.out_dir, 'digits.pdf'), 'rb') as f:
+            self.assertTrue(f.read().startswith(b'%PDF'))
+
+    def test_incremental(self):
+        self.build([self.spec])
+        before = self.mtimes()
+        self.build([self.spec])
+        self.assertEqual(self.mtimes(), before)
+
+        self.build([dict(self.spec, nr=2)])
+        after = self.mtimes()
+        self.assertNotEqual(after['digits.pdf'], before['digits.pdf'])
+
+    def test_unknown_character(self):
+        failed = self.build([dict(self.spec, chars='一A')])
+        self.assertEqual(set(failed.values()), {"Unknown character: 'A'"})
+        with open(os.path.join(self.out_dir, BUILD_STATE_FILE)) as f:
+            self.assertEqual(json.load(f), {})
+
+    @unittest.mock.patch.dict(globals(),
+                              {'gen_pdf': lambda _: b'Simulated failure'})
+    def test_broken_pdf(self):
+        spec = dict(self.spec, actions=['generate', 'preview_small'])
+        failed = self.build([spec])
+        self.assertEqual(list(failed), [os.path.join(self.out_dir,
+                                                     'digits.pdf')])
+        self.assertIn('PdfReadError', failed[os.path.join(self.out_dir,
+                                                          'digits.pdf')])
+        with open(os.path.join(self.out_dir, BUILD_STATE_FILE)) as f:
+            self.assertEqual(list(json.load(f)), ['digits.preview_small.html'])
+        with open(os.path.join(self.out_dir, 'nginx.map')) as f:
+            self.assertNotIn('digits.pdf', f.read())
+
+    def test_nginx_map(self):
+        self.build([dict(self.spec, actions=['generate'])])
+        with open(os.path.join(self.out_dir, 'nginx.map')) as f:
+            line = f.read()
+        self.assertTrue(line.startswith('"/gen_strokes?chars=%E4%B8%80'))
+        self.assertTrue(line.endswith('&action=generate" digits.pdf;\n'))
+        self.assertFalse([name for name in os.listdir(self.out_dir)
+                          if name.endswith('.tmp')])
+
+    def test_load_specs(self):
+        txt_path = os.path.join(self.tmp.name, 'hsk1.txt')
+        with open(txt_path, 'w', encoding='utf8') as f:
+            f.write('一\n二\n')
+        manifest_path = os.path.join(self.tmp.name, 'manifest.json')
+        with open(manifest_path, 'w') as f:
+            json.dump([{'name': 'big', 'chars_file': 'hsk1.txt',
+                        'scale': 150}], f)
+        specs = load_build_specs([txt_path, manifest_path])
+        self.assertEqual([(s['name'], s['chars'], s['scale'])
+                          for s in specs],
+                         [('hsk1', '一二', 100), ('big', '一二', 150)])
+
+    def test_load_specs_txt_name(self):
+        txt_path = os.path.join(self.tmp.name, 'HSK Official 2012 L1.txt')
+        with open(txt_path, 'w', encoding='utf8') as f:
+            f.write('一')
+        self.assertEqual(load_build_specs([txt_path])[0]['name'],
+                         'HSK_Official_2012_L1')
+
+    def test_nodupes_uri(self):
+        uri = static_request_uri(dict(self.spec, nodupes=True), 'generate')
+        self.assertIn('&sorting=none&nodupes=true&action=generate', uri)
+
+    def test_invalid_action(self):
+        for actions in [['invalid'], 'generate', [['generate']]]:
+            manifest_path = self.write_manifest([
+                {'name': 'x', 'chars': '一', 'actions': actions}])
+            with self.assertRaises(ValueError):
+                load_build_specs([manifest_path])
+
+    def test_parallel(self):
+        specs = [dict(self.spec, name=name, actions=['preview_small'])
+                 for name in ('a', 'b')]
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(build_static(specs, self.out_dir, jobs=2), {})
+        self.assertIn('b.preview_small.html', os.listdir(self.out_dir))
+
+    def test_main(self):
+        manifest_path = os.path.join(self.tmp.name, 'manifest.json')
+        with open(manifest_path, 'w') as f:
+            json.dump([{'name': 'x', 'chars': '一A',
+                        'actions': ['preview_small']}], f)
+        argv = ['strokes.py', '-o', self.out_dir, manifest_path]
+        with unittest.mock.patch('sys.argv', argv), \
+                contextlib.redirect_stdout(io.StringIO()) as out:
+            with self.assertRaises(SystemExit) as cm:
+                main()
+        self.assertEqual(cm.exception.code, 1)
+        self.assertIn("Unknown character: 'A'", out.getvalue())
+
+    def test_main_invalid_spec(self):
+        manifest_path = self.write_manifest([{'name': 'x', 'chars': '一',
+                                              'scale': '100'}])
+        argv = ['strokes.py', '-o', self.out_dir, manifest_path]
+        with unittest.mock.patch('sys.argv', argv), \
+                contextlib.redirect_stderr(io.StringIO()) as err:
+            with self.assertRaises(SystemExit) as cm:
+                main()
+        self.assertEqual(cm.exception.code, 2)
+        self.assertIn("'scale' must be an integer", err.getvalue())
+        self.assertFalse(os.path.exists(self.out_dir))
+
+    def test_missing_gz_rebuilt(self):
+        self.build([self.spec])
+        os.unlink(os.path.join(self.out_dir, 'digits.preview_small.html.gz'))
+        self.build([self.spec])
+        self.assertIn('digits.preview_small.html.gz',
+                      os.listdir(self.out_dir))
+
+    def write_manifest(self, specs):
+        manifest_path = os.path.join(self.tmp.name, 'manifest.json')
+        with open(manifest_path, 'w') as f:
+            json.dump(specs, f)
+        return manifest_path
+
+    def test_load_specs_invalid(self):
+        for specs in [[{'chars': '一'}],
+                      [{'name': '../x', 'chars': '一'}],
+                      [{'name': '.strokes-build', 'chars': '一'}],
+                      [{'name': 'hsk 1', 'chars': '一'}],
+                      [{'name': 'a;b', 'chars': '一'}],
+                      [{'name': '${x}', 'chars': '一'}],
+                      [{'name': '"x"', 'chars': '一'}],
+                      [{'name': 1, 'chars': '一'}],
+                      [{'name': 'x'}],
+                      [{'name': 'x', 'chars': '一', 'chars_file': 'y'}],
+                      [{'name': 'x', 'chars': '一'},
+                       {'name': 'x', 'chars': '二'}],
+                      [{'name': 'x', 'chars': '一', 'scale': '100'}],
+                      [{'name': 'x', 'chars': '一', 'scale': 5}],
+                      [{'name': 'x', 'chars': '一', 'scale': True}],
+                      [{'name': 'x', 'chars': '一', 'nr': '1'}],
+                      [{'name': 'x', 'chars': '一', 'nr': -1}],
+                      [{'name': 'x', 'chars': '一', 'nodupes': 'false'}],
+                      [{'name': 'x', 'chars': ['一']}],
+                      [{'name': 'x', 'chars_file': 1}],
+                      {'name': 'x', 'chars': '一'},
+                      ['x']]:
+            with self.assertRaises(ValueError):
+                load_build_specs([self.write_manifest(specs)])
+
+    def test_load_specs_duplicate_files(self):
+        paths = []
+        for subdir in ('a', 'b'):
+            os.mkdir(os.path.join(self.tmp.name, subdir))
+            paths.append(os.path.join(self.tmp.name, subdir, 'hsk1.txt'))
+            with open(paths[-1], 'w', encoding='utf8') as f:
+                f.write('一')
+        with self.assertRaises(ValueError):
+            load_build_specs(paths)
+
+    def test_load_specs_unexpected_key(self):
+        manifest_path = os.path.join(self.tmp.name, 'manifest.json')
+        with open(manifest_path, 'w') as f:
+            json.dump([{'name': 'x', 'chars': '一', 'wtf': 1}], f)
+        with self.assertRaises(ValueError):
+            load_build_specs([manifest_path])
+
+
 # I was too lazy to write regular unit tests and this is already pretty fast
 # and gives decent coverage, so some red flags will be caught:
 class SystemTests(unittest.TestCase):
@@ -666,6 +1545,67 @@ class SystemTests(unittest.TestCase):
         rv = self.app.get('/gen_strokes', query_string=data)
         self.assertEqual(rv.status, '200 OK')
 
+    def test_smallpreview_gzip(self):
+        data = {'scale': 12, 'nr': 1, 'action': 'preview_small',
+                'chars': '一'}
+        rv = self.app.get('/gen_strokes', query_string=data,
+                          headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(rv.status, '200 OK')
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        body = zlib.decompress(rv.data, 16 + zlib.MAX_WBITS)
+        self.assertTrue(body.startswith(b'<body><svg'))
+
+    @unittest.skipIf(brotli is None, 'brotli is not installed')
+    def test_bigpreview_brotli(self):
+        data = {'scale': 12, 'nr': 1, 'action': 'preview_large',
+                'chars': '一'}
+        rv = self.app.get('/gen_strokes', query_string=data,
+                          headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(rv.status, '200 OK')
+        self.assertEqual(rv.headers['Content-Encoding'], 'br')
+        self.assertTrue(brotli.decompress(rv.data).startswith(b'<body><img'))
+
+    def test_smallpreview_identity(self):
+        data = {'scale': 12, 'nr': 1, 'action': 'preview_small',
+                'chars': '一'}
+        rv = self.app.get('/gen_strokes', query_string=data)
+        self.assertEqual(rv.status, '200 OK')
+        self.assertNotIn('Content-Encoding', rv.headers)
+        self.assertTrue(rv.data.startswith(b'<body><svg'))
+
+    def test_get_index_gzip(self):
+        rv = self.app.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(rv.status, '200 OK')
+        body = zlib.decompress(rv.data, 16 + zlib.MAX_WBITS)
+        self.assertIn(b'<title>Strokes', body)
+
+    def test_lookup(self):
+        query = {'radical': '女', 'strokes': 6}
+        rv = self.app.get('/lookup', query_string=query)
+        self.assertEqual(rv.status, '200 OK')
+        self.assertIn('好', rv.get_json()['chars'])
+        data = {'scale': 12, 'nr': 0, 'action': 'preview_small',
+                'chars': rv.get_json()['chars']}
+        rv = self.app.get('/gen_strokes', query_string=data)
+        self.assertEqual(rv.status, '200 OK')
+
+    def test_lookup_no_query(self):
+        rv = self.app.get('/lookup')
+        self.assertEqual(rv.status_code, 400)
+
+    def test_lookup_unknown_field(self):
+        rv = self.app.get('/lookup', query_string={'wtf': 'yes'})
+        self.assertEqual(rv.status_code, 400)
+
+    def test_lookup_char(self):
+        rv = self.app.get('/lookup/好')
+        self.assertEqual(rv.status, '200 OK')
+        self.assertEqual(rv.get_json()['components'], ['女', '子'])
+
+    def test_lookup_unknown_char(self):
+        rv = self.app.get('/lookup/A')
+        self.assertEqual(rv.status_code, 404)
+
     def test_fivedigits_smallpreview_norepeats(self):
         data = {'scale': 12, 'nr': 0, 'action': 'preview_small',
                 'chars': '一二三四五'}
@@ -749,3 +1689,7 @@ class SystemTests(unittest.TestCase):
                 'action': 'preview_small'}
         rv = self.app.get('/gen_strokes', query_string=data)
         self.assertNotEqual(rv.status, '200 OK')
+
+
+if __name__ == '__main__':
+    main()